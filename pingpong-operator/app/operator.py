@@ -10,11 +10,21 @@ Creates:
 On update:
  - updates statefulset (replica, image change)
  - updates ConfigMap
+
+All of them are written with server-side apply, so create and resume go
+through the same idempotent handler, and per-field handlers re-apply only
+the resources that depend on the changed field.
 """
 
+import json
 import kopf
 import kubernetes
 import logging
+import os
+import threading
+import time
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor, wait, ALL_COMPLETED
 from kubernetes.client.rest import ApiException
 
 GROUP = "apps.example.com"
@@ -25,33 +35,140 @@ CONTAINER_PORT = 80
 CONFIG_FILENAME = "config.yaml"
 MOUNT_PATH = "/var/server"
 CONFIG_KEY = "config.yaml"
+DEFAULT_IMAGE = "6y6en/ping-pong:latest"
+FIELD_MANAGER = "pingpong-operator"
+# set on the objects' own metadata only (not selectors/pod templates), so the
+# StatefulSet reflector can select exactly what this operator manages
+MANAGED_BY_LABELS = {"app.kubernetes.io/managed-by": FIELD_MANAGER}
+MANAGED_BY_SELECTOR = ",".join(f"{k}={v}" for k, v in MANAGED_BY_LABELS.items())
+
+# urllib3 connection pool size for API server calls (the python client has no
+# QPS/burst limiter like client-go, the pool size is what caps concurrent calls)
+KUBE_CLIENT_POOL_MAXSIZE = int(os.environ.get("KUBE_CLIENT_POOL_MAXSIZE", 100))
 
 # Initialize kubernetes client
-kubernetes.config.load_incluster_config()
-core = kubernetes.client.CoreV1Api()
-apps = kubernetes.client.AppsV1Api()
-
-def configmap_manifest(name, namespace, replicas, timer, labels):
-    data = f"replicas: {replicas}\ntimer: {timer}\n"
-    return kubernetes.client.V1ConfigMap(
-        metadata=kubernetes.client.V1ObjectMeta(name=name, namespace=namespace, labels=labels),
+configuration = kubernetes.client.Configuration()
+kubernetes.config.load_incluster_config(client_configuration=configuration)
+configuration.connection_pool_maxsize = KUBE_CLIENT_POOL_MAXSIZE
+api_client = kubernetes.client.ApiClient(configuration)
+core = kubernetes.client.CoreV1Api(api_client)
+apps = kubernetes.client.AppsV1Api(api_client)
+
+# Local StatefulSet cache fed by a list+watch per namespace: (namespace, name) -> V1StatefulSet
+sts_cache = {}
+_cache_lock = threading.Lock()
+_watched_namespaces = set()
+_watch_lock = threading.Lock()
+
+
+def cache_statefulset(namespace, sts):
+    """Store a StatefulSet in sts_cache unless the cached copy is from a newer spec.
+
+    Both the watch and the operator's own applies write here, and a watch event
+    can arrive after the apply that superseded it; metadata.generation only
+    grows with spec changes, so an older generation is dropped.
+    """
+    key = (namespace, sts.metadata.name)
+    with _cache_lock:
+        cached = sts_cache.get(key)
+        if cached and (cached.metadata.generation or 0) > (sts.metadata.generation or 0):
+            return
+        sts_cache[key] = sts
+
+
+def uncache_statefulsets(namespace, keep=()):
+    """Drop cached StatefulSets of a namespace, except the names in keep."""
+    with _cache_lock:
+        for key in [k for k in sts_cache if k[0] == namespace and k[1] not in keep]:
+            del sts_cache[key]
+
+
+def watch_statefulsets(namespace):
+    """Reflector: list StatefulSets once, then keep sts_cache in sync from the watch stream."""
+    while True:
+        try:
+            sts_list = apps.list_namespaced_stateful_set(namespace, label_selector=MANAGED_BY_SELECTOR)
+            observed = {sts.metadata.name: sts for sts in sts_list.items}
+            uncache_statefulsets(namespace, keep=observed)
+            for sts in observed.values():
+                cache_statefulset(namespace, sts)
+
+            w = kubernetes.watch.Watch()
+            for event in w.stream(apps.list_namespaced_stateful_set, namespace=namespace,
+                                  label_selector=MANAGED_BY_SELECTOR, resource_version=sts_list.metadata.resource_version):
+                if event["type"] == "ERROR":
+                    # most likely 410 Gone (resource version too old), relist
+                    break
+                sts = event["object"]
+                if event["type"] == "DELETED":
+                    with _cache_lock:
+                        sts_cache.pop((namespace, sts.metadata.name), None)
+                else:
+                    cache_statefulset(namespace, sts)
+        except Exception as e:
+            logging.warning(f"StatefulSet watch in {namespace} failed, relisting: {e}")
+            time.sleep(1)
+
+
+def ensure_watch(namespace):
+    """Start the StatefulSet reflector for a namespace once."""
+    with _watch_lock:
+        if namespace in _watched_namespaces:
+            return
+        _watched_namespaces.add(namespace)
+    threading.Thread(target=watch_statefulsets, args=(namespace,), daemon=True).start()
+
+
+def resource_names(name):
+    """Names of the Service, StatefulSet and ConfigMap owned by a PingPong CR."""
+    return f"{name}-svc", f"{name}-sts", f"{name}-cm"
+
+
+def labels_for(name):
+    """Labels of a PingPong's resources, as a tuple so they can key the manifest caches."""
+    return (("app", name),)
+
+
+def config_data(replicas, timer):
+    # JSON is valid YAML, and lets the servers parse it with the C json module
+    return json.dumps({"replicas": replicas, "timer": timer})
+
+
+# Manifest builders are cached on their (hashable) inputs, so kopf retries of the same
+# spec skip rebuilding. They take labels as a tuple of pairs and return the serialized
+# dict, which is shared between calls and must not be modified.
+
+@lru_cache(maxsize=128)
+def configmap_manifest(name, namespace, replicas, timer, labels_tuple):
+    labels = dict(labels_tuple)
+    data = config_data(replicas, timer)
+    return api_client.sanitize_for_serialization(kubernetes.client.V1ConfigMap(
+        api_version="v1",
+        kind="ConfigMap",
+        metadata=kubernetes.client.V1ObjectMeta(name=name, namespace=namespace, labels={**labels, **MANAGED_BY_LABELS}),
         data={CONFIG_KEY: data},
-    )
+    ))
 
 
-def service_manifest(name, namespace, labels):
+@lru_cache(maxsize=128)
+def service_manifest(name, namespace, labels_tuple):
+    labels = dict(labels_tuple)
     spec = kubernetes.client.V1ServiceSpec(
         cluster_ip="None",
         selector=labels,
         ports=[kubernetes.client.V1ServicePort(port=CONTAINER_PORT, target_port=CONTAINER_PORT, protocol="TCP")],
     )
-    return kubernetes.client.V1Service(
-        metadata=kubernetes.client.V1ObjectMeta(name=name, namespace=namespace, labels=labels),
+    return api_client.sanitize_for_serialization(kubernetes.client.V1Service(
+        api_version="v1",
+        kind="Service",
+        metadata=kubernetes.client.V1ObjectMeta(name=name, namespace=namespace, labels={**labels, **MANAGED_BY_LABELS}),
         spec=spec,
-    )
+    ))
 
 
-def statefulset_manifest(name, service_name, configmap_name, namespace, labels, replicas, image):
+@lru_cache(maxsize=128)
+def statefulset_manifest(name, service_name, configmap_name, namespace, labels_tuple, replicas, image):
+    labels = dict(labels_tuple)
     container = kubernetes.client.V1Container(
         name="main",
         image=image,
@@ -102,117 +219,106 @@ def statefulset_manifest(name, service_name, configmap_name, namespace, labels,
         template=pod_template,
     )
 
-    return kubernetes.client.V1StatefulSet(
-        metadata=kubernetes.client.V1ObjectMeta(name=name, namespace=namespace, labels=labels),
+    return api_client.sanitize_for_serialization(kubernetes.client.V1StatefulSet(
+        api_version="apps/v1",
+        kind="StatefulSet",
+        metadata=kubernetes.client.V1ObjectMeta(name=name, namespace=namespace, labels={**labels, **MANAGED_BY_LABELS}),
         spec=spec,
-    )
+    ))
 
 
-@kopf.on.create(GROUP, VERSION, PLURAL)
-def create_fn(spec, name, namespace, logger, **kwargs):
+def apply(patch_fn, name, namespace, manifest, logger):
+    """Server-side apply a manifest, the apiserver creates or merges it as needed. Returns the applied object."""
+    try:
+        result = patch_fn(name, namespace, manifest, field_manager=FIELD_MANAGER, force=True,
+                          _content_type="application/apply-patch+yaml")
+        logger.info(f"Applied {manifest['kind']} {name}")
+        return result
+    except ApiException as e:
+        logger.error(f"Failed to apply {manifest['kind']} {name}: {e}")
+        raise
+
+
+def apply_configmap(spec, name, namespace, logger):
     replicas = int(spec.get("replicas", 1))
     timer = int(spec.get("timer", 30))
-    image = spec.get('image', '6y6en/ping-pong:latest') 
+    _, _, cm_name = resource_names(name)
+    apply(core.patch_namespaced_config_map, cm_name, namespace,
+          configmap_manifest(cm_name, namespace, replicas, timer, labels_for(name)), logger)
 
-    # resources will be named based on CR name
-    svc_name = f"{name}-svc"
-    sts_name = f"{name}-sts"
-    cm_name = f"{name}-cm"
-    labels = {"app": name}
 
-    logger.info(f"Creating PingPong resources: svc={svc_name}, sts={sts_name}, cm={cm_name}, replicas={replicas}, timer={timer}")
+def apply_statefulset(spec, name, namespace, logger, use_cache=True):
+    """Apply the StatefulSet.
 
-    # 1) create headless service
-    svc_manifest = service_manifest(svc_name, namespace, labels)
-    try:
-        core.create_namespaced_service(namespace=namespace, body=svc_manifest)
-        logger.info(f"Service {svc_name} created")
-    except ApiException as e:
-        if e.status == 409:
-            logger.info(f"Service {svc_name} already exists")
-        else:
-            raise
+    With use_cache, the apply is skipped if the cached object already has the
+    desired replicas and image; that is only safe on field updates, where
+    nothing else in the manifest can have changed. create/resume always apply.
+    """
+    replicas = int(spec.get("replicas", 1))
+    image = spec.get("image", DEFAULT_IMAGE)
+    svc_name, sts_name, cm_name = resource_names(name)
+    ensure_watch(namespace)
+
+    observed = sts_cache.get((namespace, sts_name)) if use_cache else None
+    if observed and observed.spec.replicas == replicas \
+            and observed.spec.template.spec.containers[0].image == image:
+        logger.info(f"StatefulSet {sts_name} already up to date")
+        return
+    sts = apply(apps.patch_namespaced_stateful_set, sts_name, namespace,
+                statefulset_manifest(sts_name, svc_name, cm_name, namespace, labels_for(name), replicas, image),
+                logger)
+    # write through, so the cache is never older than our own last apply
+    cache_statefulset(namespace, sts)
+
+
+@kopf.on.resume(GROUP, VERSION, PLURAL)
+@kopf.on.create(GROUP, VERSION, PLURAL)
+def reconcile_fn(spec, name, namespace, logger, **kwargs):
+    # resources will be named based on CR name
+    svc_name, sts_name, cm_name = resource_names(name)
 
-    # 2) create configmap
-    cm_manifest = configmap_manifest(cm_name, namespace, replicas, timer, labels)
-    try:
-        core.create_namespaced_config_map(namespace=namespace, body=cm_manifest)
-        logger.info(f"ConfigMap {cm_name} created")
-    except ApiException as e:
-        if e.status == 409:
-            logger.info(f"ConfigMap {cm_name} already exists")
-        else:
-            raise
+    # create/resume: make sure everything exists and matches the spec
+    logger.info(f"Applying PingPong resources: svc={svc_name}, sts={sts_name}, cm={cm_name}, spec={dict(spec)}")
 
-    # 3) create statefulset
-    sts_manifest = statefulset_manifest(sts_name, svc_name, cm_name, namespace, labels, replicas, image)
-    try:
-        apps.create_namespaced_stateful_set(namespace=namespace, body=sts_manifest)
-        logger.info(f"StatefulSet {sts_name} created")
-    except ApiException as e:
-        if e.status == 409:
-            logger.info(f"StatefulSet {sts_name} already exists")
-        else:
-            raise
+    # 1) headless service, never changes after creation
+    apply(core.patch_namespaced_service, svc_name, namespace,
+          service_manifest(svc_name, namespace, labels_for(name)), logger)
+    # 2) configmap
+    apply_configmap(spec, name, namespace, logger)
+    # 3) statefulset, always applied in full so any drift (or a new template) is fixed
+    apply_statefulset(spec, name, namespace, logger, use_cache=False)
 
     # store names for later handlers
     return {"svc_name": svc_name, "sts_name": sts_name, "cm_name": cm_name}
 
 
-@kopf.on.update(GROUP, VERSION, PLURAL)
-def update_fn(spec, name, namespace, diff, logger, **kwargs):
-    image = spec.get('image')
-    replicas = spec.get('replicas')
-    timer = spec.get('timer')
-
-    sts_name = f"{name}-sts"
-    cm_name = f"{name}-cm"
-
-    for change in diff:
-        field, old, new = change[1], change[2], change[3]
-        logger.info(f"Detected change in {field}: {old} -> {new}")
-
-    ss_body = {"spec": {
-                "replicas": replicas,
-                "template": {
-                    "spec": {
-                        "containers": [
-                            {"name": "main", "image": image}
-                        ]
-                    }
-                }
-            },
-        }
+# On updates kopf only calls the handlers whose field actually changed.
+@kopf.on.update(GROUP, VERSION, PLURAL, field="spec.replicas")
+def replicas_fn(spec, name, namespace, old, new, logger, **kwargs):
+    logger.info(f"Detected change in spec.replicas: {old} -> {new}")
+    apply_statefulset(spec, name, namespace, logger)
+    apply_configmap(spec, name, namespace, logger)
 
-    try:
-        apps.patch_namespaced_stateful_set(sts_name, namespace, ss_body)
-        logging.info(f"Updated StatefulSet {sts_name}")
-    except ApiException as e:
-        logging.error(f"Failed to update StatefulSet: {e}")
 
-    cm_data = f"replicas: {replicas}\ntimer: {timer}\n"
-    cm_body = {"data": {CONFIG_KEY: cm_data}}
-    
-    try:
-        core.patch_namespaced_config_map(cm_name, namespace, cm_body)
-        logging.info(f"Updated ConfigMap {cm_name}")
-    except ApiException as e:
-        logging.error(f"Failed to update ConfigMap: {e}")
+@kopf.on.update(GROUP, VERSION, PLURAL, field="spec.image")
+def image_fn(spec, name, namespace, old, new, logger, **kwargs):
+    logger.info(f"Detected change in spec.image: {old} -> {new}")
+    apply_statefulset(spec, name, namespace, logger)
+
+
+@kopf.on.update(GROUP, VERSION, PLURAL, field="spec.timer")
+def timer_fn(spec, name, namespace, old, new, logger, **kwargs):
+    logger.info(f"Detected change in spec.timer: {old} -> {new}")
+    apply_configmap(spec, name, namespace, logger)
 
 
 @kopf.on.delete(GROUP, VERSION, PLURAL)
 def delete_fn(spec, name, namespace, logger, **kwargs):
     # Optionally delete associated k8s resources (svc, sts, cm).
     # Here we attempt to delete them; ignore NotFound errors.
-    svc_name = f"{name}-svc"
-    sts_name = f"{name}-sts"
-    cm_name = f"{name}-cm"
-
-    for fn, n in [
-        (core.delete_namespaced_service, svc_name),
-        (apps.delete_namespaced_stateful_set, sts_name),
-        (core.delete_namespaced_config_map, cm_name),
-    ]:
+    svc_name, sts_name, cm_name = resource_names(name)
+
+    def delete(fn, n):
         try:
             fn(name=n, namespace=namespace)
             logger.info(f"Deleted {n}")
@@ -221,3 +327,14 @@ def delete_fn(spec, name, namespace, logger, **kwargs):
                 logger.info(f"{n} already deleted")
             else:
                 logger.error(f"Failed to delete {n}: {e}")
+
+    # resources are independent, delete them in parallel
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        futures = [executor.submit(delete, fn, n) for fn, n in [
+            (core.delete_namespaced_service, svc_name),
+            (apps.delete_namespaced_stateful_set, sts_name),
+            (core.delete_namespaced_config_map, cm_name),
+        ]]
+        wait(futures, return_when=ALL_COMPLETED)
+    for future in futures:
+        future.result()
@@ -0,0 +1,11 @@
+"""gunicorn hooks for the pingpong server."""
+
+
+def post_worker_init(worker):
+    """Start the background ping thread once the worker has loaded the app.
+
+    Runs in every worker, start_background_thread() takes a file lock so
+    only one of them actually pings.
+    """
+    from main import start_background_thread
+    start_background_thread()
@@ -1,13 +1,23 @@
+import asyncio
+import fcntl
 import threading
-# import time
-import requests
-import yaml
+import time
+import httpx
+import json
 import sys
 import os
+import socket
 import logging
 from flask import Flask, jsonify
+from inotify_simple import INotify, flags
 
 CONFIG_PATH = "/var/server/config.yaml"
+CONFIG_DIR = os.path.dirname(CONFIG_PATH)
+LOCK_PATH = "/tmp/pingpong.lock"
+POOL_SIZE = 64
+PING_TIMEOUT = httpx.Timeout(0.8, connect=0.2)
+MAX_SKIP_CYCLES = 4  # small, so peers that were just not up yet (OrderedReady rollout) are retried soon
+PEER_ADDR_TTL = 30  # seconds, CoreDNS default TTL for pod records; pod IPs get reused
 
 app = Flask(__name__)
 
@@ -27,18 +37,75 @@ config = {"replicas": 0, "timer": 6000}
 pod_prefix = ""
 pod_number = 0
 service_name = ""
-stop_event = threading.Event()
+# background event loop running the config watcher and ping loop on one thread
+_loop = None
+stop_event = asyncio.Event()
+reload_event = asyncio.Event()  # set on config reload to wake ping_loop early
+_cfg_mtime = 0
+_peers = ()  # (replica number, host) for every other replica, rebuilt on config reload
+_peer_addrs = {}  # host -> (resolved IP, monotonic time resolved), dropped when a ping to it fails
+# circuit breaker for dead peers: host -> consecutive failures / cycle to retry at
+_fail_counts = {}
+_skip_until = {}
+_leader_lock = None  # held open by the one worker that runs the background loop
 
 
-def load_config():
-    """Load configuration from YAML file."""
+def parse_config(text):
+    """Parse config.yaml content.
+
+    The operator writes JSON (valid YAML), so the C json parser covers it.
+    ConfigMaps written by older operator versions use flat `key: value`
+    lines, which are parsed by hand as a fallback.
+    """
+    try:
+        return json.loads(text)
+    except ValueError:
+        pass
+    parsed = {}
+    for line in text.splitlines():
+        key, sep, value = line.partition(":")
+        key, value = key.strip(), value.strip()
+        if not sep or not key or key.startswith("#"):
+            continue
+        parsed[key] = int(value) if value.lstrip("-").isdigit() else value
+    return parsed
+
+
+def load_config(force=False):
+    """Load configuration from file, skipping the parse if the file is unchanged.
+
+    Returns True if the config was (re)loaded.
+    """
     global config
+    global _cfg_mtime
     try:
+        mtime = os.stat(CONFIG_PATH).st_mtime_ns
+        if mtime == _cfg_mtime and not force:
+            return False
         with open(CONFIG_PATH, "r") as f:
-            config = yaml.safe_load(f) or config
+            config = parse_config(f.read()) or config
+        _cfg_mtime = mtime
         app.logger.info(f"Config loaded: {config}")
+        build_peers()
+        return True
     except Exception as e:
         app.logger.error(f"Failed to load config: {e}")
+        return False
+
+
+def build_peers():
+    """Precompute host names of all other replicas (on every config reload)."""
+    global _peers
+    # new config, give every peer a fresh chance (e.g. pods just scaled up)
+    _fail_counts.clear()
+    _skip_until.clear()
+    _peer_addrs.clear()
+    suffix = f".{service_name}" if service_name else ""
+    _peers = tuple(
+        (i, f"{pod_prefix}-{i}{suffix}")
+        for i in range(0, config.get("replicas"))
+        if i != pod_number
+    )
 
 
 def define_cluster():
@@ -54,58 +121,179 @@ def define_cluster():
     app.logger.info(f"Service name: {service_name}")
 
 
-def ping_loop():
+def force_reload():
+    """Re-read the config and wake ping_loop, must run on the event loop (it owns the peer state)."""
+    if load_config(force=True):
+        reload_event.set()
+
+
+def watch_config():
+    """Reload config whenever the mounted file changes.
+
+    kubelet updates ConfigMap volumes by swapping the ..data symlink inside
+    the mount directory (IN_CREATE/IN_MOVED_TO on the directory), while a
+    plain bind mount (docker compose) is rewritten in place (IN_MODIFY on
+    the file itself), so both are watched. The inotify fd is registered
+    with the event loop, so no thread blocks on it.
+    """
+    inotify = INotify()
+    try:
+        inotify.add_watch(CONFIG_DIR, flags.CREATE | flags.MOVED_TO | flags.MODIFY | flags.CLOSE_WRITE)
+    except OSError as e:
+        app.logger.error(f"Failed to watch {CONFIG_DIR}, config will not be reloaded: {e}")
+        return
+
+    def watch_file():
+        try:
+            inotify.add_watch(CONFIG_PATH, flags.MODIFY | flags.CLOSE_WRITE)
+        except OSError as e:
+            app.logger.warning(f"Failed to watch {CONFIG_PATH}: {e}")
+
+    def on_change():
+        inotify.read(timeout=0)  # drain pending events
+        watch_file()
+        if load_config():
+            reload_event.set()
+
+    watch_file()
+    _loop.add_reader(inotify.fileno(), on_change)
+
+
+async def wait_next_cycle(timer):
+    """Sleep for timer seconds, or until the config is reloaded (new timer/replicas apply right away).
+
+    Whoever sets stop_event should also set reload_event to cut the wait short.
+    """
+    try:
+        await asyncio.wait_for(reload_event.wait(), timer)
+    except asyncio.TimeoutError:
+        pass
+    reload_event.clear()
+
+
+async def resolve_peer(host):
+    """Resolve a peer's pod IP and cache it for PEER_ADDR_TTL, instead of a DNS query on every ping.
+
+    The TTL matters: a rescheduled peer's old IP can be handed to another pod
+    that also answers /ping (Host is not checked), so an IP is never trusted
+    for longer than DNS itself would cache it.
+    """
+    now = time.monotonic()
+    cached = _peer_addrs.get(host)
+    if cached is not None and now - cached[1] < PEER_ADDR_TTL:
+        return cached[0]
+    infos = await asyncio.get_running_loop().getaddrinfo(host, 80, type=socket.SOCK_STREAM)
+    ip = infos[0][4][0]
+    _peer_addrs[host] = (ip, now)
+    return ip
+
+
+async def ping_peer(client, cycle, i, host):
+    """Ping one replica, peers that keep failing are skipped for exponentially more cycles (capped at a few)."""
+    try:
+        ip = await resolve_peer(host)
+        addr = f"[{ip}]" if ":" in ip else ip
+        r = await client.get(f"http://{addr}/ping", headers={"Host": host})
+        _fail_counts.pop(host, None)
+        app.logger.info(f"Ping from server {pod_number} to server {i} -> {r.text}")
+    except Exception as e:
+        _peer_addrs.pop(host, None)
+        _fail_counts[host] = _fail_counts.get(host, 0) + 1
+        skip = min(2 ** _fail_counts[host], MAX_SKIP_CYCLES)
+        _skip_until[host] = cycle + skip + 1  # skip exactly `skip` cycles
+        app.logger.warning(f"Ping {host} failed, skipping it for {skip} cycles: {e}")
+
+
+async def ping_loop():
     """Background loop that pings replicas periodically."""
-    while not stop_event.is_set():
-        load_config()
-        replicas = config.get("replicas")
-        timer = config.get("timer")
+    limits = httpx.Limits(max_connections=POOL_SIZE, max_keepalive_connections=POOL_SIZE)
+    # one keep-alive client for all pings, so connections to peers are reused
+    async with httpx.AsyncClient(timeout=PING_TIMEOUT, limits=limits) as client:
+        # drop default User-Agent/Accept/Accept-Encoding/Connection headers, a ping only needs
+        # the request line and Host (HTTP/1.1 connections are persistent by default);
+        # unlike requests/urllib3, httpx adds nothing back once they are cleared
+        client.headers.clear()
+        cycle = 0
+        while not stop_event.is_set():
+            cycle += 1
+            timer = config.get("timer")
+
+            # fan out all pings at once, each one logs as its response arrives
+            await asyncio.gather(*(
+                ping_peer(client, cycle, i, host)
+                for i, host in _peers
+                if cycle >= _skip_until.get(host, 0)
+            ))
 
-        for i in range(0, replicas):
-            if i == pod_number:
-                #app.logger.info(f"same pod {pod_number} == {i}")
-                continue
+            await wait_next_cycle(timer)
 
-            url = f"http://{pod_prefix}-{i}{'.'+service_name if service_name else ''}/ping"
-            #url = f"http://{pod_prefix}-{i}/ping"
-            try:
-                r = requests.get(url, timeout=1)
-                app.logger.info(f"Ping from server {pod_number} to server {i} -> {r.text}")
-            except Exception as e:
-                app.logger.warning(f"Ping {url} failed: {e}")
 
-        stop_event.wait(timer)
+def run_background_loop():
+    """Run the config watcher and the ping loop on one event loop in this thread."""
+    global _loop
+    _loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(_loop)
+    watch_config()
+    _loop.run_until_complete(ping_loop())
+
+
+def acquire_leader_lock():
+    """Only one gunicorn worker per pod may ping, the first one to grab the lock wins."""
+    global _leader_lock
+    f = open(LOCK_PATH, "w")
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        f.close()
+        return False
+    _leader_lock = f
+    return True
 
 
 def start_background_thread():
-    """Start ping thread once (called at import)."""
-    #load_config()
+    """Start the background ping loop once per pod (called from the gunicorn worker hook)."""
+    if not acquire_leader_lock():
+        app.logger.info(f"Background ping thread already running in another worker (pid {os.getpid()})")
+        return
     define_cluster()
-    t = threading.Thread(target=ping_loop, daemon=True)
+    load_config()
+    t = threading.Thread(target=run_background_loop, daemon=True)
     t.start()
     app.logger.info("Background ping thread started")
 
 
-start_background_thread()
-
-
 @app.route('/')
 def index():
     return "ok"
 
 
+# built once, /ping is the hot endpoint and the response never changes
+_PONG = app.response_class(b"pong\n", mimetype="text/plain")
+
+
 @app.route('/ping')
 def ping():
-    return "pong\n"
+    return _PONG
 
 
 @app.route("/config")
 def get_config():
+    if _leader_lock is None:
+        load_config()  # only the leader worker watches the file, others catch up here
     return config
 
 
 @app.route("/reload")
 def reload_config():
     """Reload config from file."""
-    load_config()
+    if _loop is not None:
+        _loop.call_soon_threadsafe(force_reload)
+    else:
+        load_config(force=True)  # non-leader worker, no background loop here
     return "reloaded"
+
+
+if __name__ == "__main__":
+    # local run without gunicorn
+    start_background_thread()
+    app.run(host="0.0.0.0", port=80, threaded=True)